@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import os
+import threading
+
+
+_writeLock = threading.Lock()
+
+
+def writeFileAtomically(path, data):
+    # writes the string data to path so that readers see either the old or the new content, never a partial file.
+    # the temporary file name is unique per process, and writes from different threads are serialised.
+    tmpFile = str(path) + ".tmp." + str(os.getpid())
+    with _writeLock:
+        try:
+            with open(tmpFile, "w") as f:
+                f.write(data)
+            os.replace(tmpFile, path)
+        except BaseException:
+            try:
+                os.unlink(tmpFile)
+            except OSError:
+                pass
+            raise
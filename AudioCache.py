@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import os
+import re
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from AtomicFile import writeFileAtomically
+
+
+CACHE_DIRNAME = ".cache"   # inside the audiofolders directory, so that MPD can play the cached files
+MANIFEST_NAME = "index.json"
+
+AUDIO_SUFFIXES = [".mp3", ".ogg", ".oga", ".opus", ".flac", ".wav", ".m4a", ".aac", ".wma", ".aif", ".aiff"]
+HEAVY_SUFFIXES = [".flac", ".wav", ".aif", ".aiff"]   # decoded/resampled at high CPU cost on a pi zero
+TAGGABLE_SUFFIXES = [".mp3", ".ogg", ".oga", ".opus", ".flac"]   # ffmpeg keeps REPLAYGAIN_* tags when copying these; the others need transcoding
+
+
+def _runFFmpeg(args):
+    return subprocess.run(["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "info"] + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+
+
+def analyseLoudness(absFile: Path):
+    # returns (track gain in dB, track peak) as computed by ffmpeg's replaygain filter
+    result = _runFFmpeg(["-nostats", "-i", str(absFile), "-map", "0:a:0", "-af", "replaygain", "-f", "null", "-"])
+    if result.returncode != 0:
+        raise Exception("ffmpeg failed to analyse " + str(absFile) + ": " + result.stderr.strip()[-200:])
+
+    gain = re.search(r"track_gain = ([-+]?[0-9.]+) dB", result.stderr)
+    peak = re.search(r"track_peak = ([0-9.]+)", result.stderr)
+    if gain is None or peak is None:
+        raise Exception("no replaygain values for " + str(absFile))
+    return float(gain.group(1)), float(peak.group(1))
+
+
+def _processFile(absAudiofolder, relfile, relcache, transcode, sampleRate, quality):
+    # runs in a worker process; returns the manifest entry for relfile
+    absFile = Path(absAudiofolder) / relfile
+    absCache = Path(absAudiofolder) / relcache
+    mtime = absFile.stat().st_mtime
+
+    gain, peak = analyseLoudness(absFile)
+
+    args = ["-y", "-i", str(absFile), "-map", "0:a:0", "-map_metadata", "0"]
+    if transcode:
+        args += ["-c:a", "libvorbis", "-q:a", str(quality), "-ar", str(sampleRate)]
+    else:
+        args += ["-c:a", "copy"]
+    args += ["-metadata", "REPLAYGAIN_TRACK_GAIN={g:.2f} dB".format(g=gain),
+             "-metadata", "REPLAYGAIN_TRACK_PEAK={p:.6f}".format(p=peak)]
+
+    absCache.parent.mkdir(parents=True, exist_ok=True)
+    tmpCache = absCache.with_name(absCache.stem + ".tmp" + absCache.suffix)   # keeps the suffix, ffmpeg picks the container from it
+    result = _runFFmpeg(args + [str(tmpCache)])
+    if result.returncode != 0:
+        tmpCache.unlink(missing_ok=True)
+        raise Exception("ffmpeg failed to write " + str(absCache) + ": " + result.stderr.strip()[-200:])
+    os.replace(tmpCache, absCache)
+
+    return {"mtime": mtime, "cache": relcache, "gain": gain, "peak": peak}
+
+
+class AudioCache:
+
+    def __init__(self, absAudiofolder: Path):
+        self.absAudiofolder = absAudiofolder
+        self.absCacheDir = absAudiofolder / CACHE_DIRNAME
+        self.manifestFile = self.absCacheDir / MANIFEST_NAME
+
+        self.entries = {}
+        self.manifestMtime = None
+
+    def load(self):
+        # (re-)reads the manifest if it has changed on disk; returns False if there is no manifest
+        try:
+            mtime = self.manifestFile.stat().st_mtime
+        except OSError:
+            self.entries = {}
+            self.manifestMtime = None
+            return False
+
+        if mtime != self.manifestMtime:
+            with open(self.manifestFile, "r") as f:
+                self.entries = json.load(f)
+            self.manifestMtime = mtime
+        return True
+
+    def _save(self):
+        self.absCacheDir.mkdir(parents=True, exist_ok=True)
+        writeFileAtomically(self.manifestFile, json.dumps(self.entries))
+
+    def getCachedFile(self, relfile):
+        # returns the cached variant of relfile (relative to the audiofolders directory), or None if it is missing or outdated
+        entry = self.entries.get(relfile, None)
+        if entry is None:
+            return None
+        try:
+            if (self.absAudiofolder / relfile).stat().st_mtime != entry["mtime"] or not (self.absAudiofolder / entry["cache"]).is_file():
+                return None
+        except OSError:
+            return None
+        return entry["cache"]
+
+    def hasEntriesFor(self, relfolder):
+        prefix = relfolder.rstrip("/") + "/"
+        return any(k.startswith(prefix) for k in self.entries)
+
+    def _listAudioFiles(self):
+        visited = set()
+        for root, dirs, files in os.walk(self.absAudiofolder, followlinks=True):
+            realroot = os.path.realpath(root)
+            if realroot in visited:
+                dirs[:] = []
+                continue
+            visited.add(realroot)
+
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))   # skips the cache directory itself
+            for f in sorted(files):
+                if Path(f).suffix.lower() in AUDIO_SUFFIXES:
+                    yield Path(root, f).relative_to(self.absAudiofolder).as_posix()
+
+    def _cachePath(self, relfile, transcode):
+        # returns None if the file is not cached, i.e. an untagged copy would only waste space
+        suffix = Path(relfile).suffix.lower()
+        if transcode and (suffix in HEAVY_SUFFIXES or suffix not in TAGGABLE_SUFFIXES):
+            return (Path(CACHE_DIRNAME) / (relfile + ".ogg")).as_posix()
+        if suffix in TAGGABLE_SUFFIXES:
+            return (Path(CACHE_DIRNAME) / relfile).as_posix()
+        return None
+
+    def _removeEntry(self, relfile):
+        entry = self.entries.pop(relfile)
+        (self.absAudiofolder / entry["cache"]).unlink(missing_ok=True)
+
+    def update(self, jobs=None, transcode=False, sampleRate=44100, quality=5, saveEvery=20):
+        # analyses (and optionally transcodes) all files that are new or have changed since the last run
+        self.load()
+
+        todo = []
+        existing = set()
+        for relfile in self._listAudioFiles():
+            relcache = self._cachePath(relfile, transcode=transcode)
+            if relcache is None:
+                continue   # an entry from an earlier --transcode run is removed below
+            existing.add(relfile)
+            entry = self.entries.get(relfile, None)
+            if entry is not None and entry["cache"] == relcache and self.getCachedFile(relfile) is not None:
+                continue
+            todo.append((relfile, relcache))
+
+        for relfile in [k for k in self.entries if k not in existing]:
+            self._removeEntry(relfile)
+
+        done = 0
+        failed = 0
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for relfile, relcache in todo:
+                doTranscode = relcache != (Path(CACHE_DIRNAME) / relfile).as_posix()
+                futures[executor.submit(_processFile, str(self.absAudiofolder), relfile, relcache, doTranscode, sampleRate, quality)] = relfile
+
+            for future in as_completed(futures):
+                relfile = futures[future]
+                try:
+                    newEntry = future.result()
+                except Exception as e:
+                    print("failed: " + relfile + ": " + str(e))
+                    failed += 1
+                    continue
+
+                oldEntry = self.entries.get(relfile, None)
+                if oldEntry is not None and oldEntry["cache"] != newEntry["cache"]:
+                    self._removeEntry(relfile)
+                self.entries[relfile] = newEntry
+                done += 1
+                if done % saveEvery == 0:
+                    self._save()   # an interrupted run keeps its progress
+
+        self._save()
+        return done, failed
+
+
+if __name__ == "__main__":
+    dir_path = Path(__file__).resolve().parent
+
+    parser = argparse.ArgumentParser(description="Writes ReplayGain-tagged (and optionally transcoded) copies of shared/audiofolders into shared/audiofolders/" + CACHE_DIRNAME + ".")
+    parser.add_argument("--audiofolder", default=str(dir_path / "shared" / "audiofolders"), help="music directory (default: %(default)s)")
+    parser.add_argument("--transcode", action="store_true", help="transcode " + ", ".join(HEAVY_SUFFIXES) + " files to ogg vorbis instead of copying them; files that cannot hold ReplayGain tags (e.g. .m4a, .aac, .wma) are only cached with this option")
+    parser.add_argument("--samplerate", type=int, default=44100, help="sample rate of transcoded files (default: %(default)s)")
+    parser.add_argument("--quality", type=int, default=5, help="vorbis quality of transcoded files (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--background", action="store_true", help="run with lowest CPU priority and a single worker, e.g. next to radio.py")
+    parser.add_argument("--interval", type=int, default=None, help="re-scan every INTERVAL seconds instead of exiting")
+    args = parser.parse_args()
+
+    jobs = args.jobs
+    if args.background:
+        os.nice(19)
+        if jobs is None:
+            jobs = 1
+
+    cache = AudioCache(absAudiofolder=Path(args.audiofolder).resolve())
+    while True:
+        starttime = time.time()
+        done, failed = cache.update(jobs=jobs, transcode=args.transcode, sampleRate=args.samplerate, quality=args.quality)
+        print("processed {d} files ({f} failed) in {s:.1f}s".format(d=done, f=failed, s=time.time() - starttime))
+
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
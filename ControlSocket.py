@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import os
+import json
+import stat
+import logging
+import threading
+import socketserver
+
+
+class _ControlRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # one JSON request per line, one JSON response per line; a client may send any number of requests
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            request = None
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+                response = self.server.handleRequest(request)
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+
+            if isinstance(request, dict) and "id" in request:
+                response["id"] = request["id"]   # lets clients match responses to pipelined requests
+            self.wfile.write((json.dumps(response, separators=(",", ":")) + "\n").encode("utf-8"))
+
+
+class ControlSocket(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Unix domain socket for scripts and load tests; every client connection is served by its own daemon thread
+    daemon_threads = True
+
+    def __init__(self, socketPath, handleRequest, mode=0o660):
+        try:
+            if not stat.S_ISSOCK(os.lstat(socketPath).st_mode):
+                raise FileExistsError("not a socket, refusing to replace it: " + str(socketPath))
+            os.unlink(socketPath)   # left over from a previous run
+        except FileNotFoundError:
+            pass
+        socketserver.UnixStreamServer.__init__(self, socketPath, _ControlRequestHandler)
+        os.chmod(socketPath, mode)
+
+        self.socketPath = socketPath
+        self.handleRequest = handleRequest
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info("control socket listening on " + str(self.socketPath))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.socketPath)
+        except FileNotFoundError:
+            pass
@@ -10,12 +10,17 @@ from select import select
 class RFIDReader:
 
     def _doInit(self):
-        devices = [InputDevice(fn) for fn in list_devices()]
-        for device in devices:
-            if device.name == self.rfidReaderName:
+        if self.dev is not None:
+            self.dev.close()
+            self.dev = None
+
+        for fn in list_devices():
+            device = InputDevice(fn)
+            if self.dev is None and device.name == self.rfidReaderName:
                 self.dev = device
                 #print(f"Using RFID reader: {self.rfidReaderName}")
-                break
+            else:
+                device.close()   # otherwise, every retry leaks one fd per input device
 
     def __init__(self, rfidReaderName):
         self.rfidReaderName = rfidReaderName
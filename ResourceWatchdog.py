@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import os
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+from AtomicFile import writeFileAtomically
+
+
+class LatencyStats:
+    # collects durations of e.g. playAction calls; the window maximum is reset by the watchdog after each sample
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.lastMs = None
+        self.maxMs = 0.0
+        self.windowMaxMs = 0.0
+
+    def record(self, durationS):
+        ms = durationS * 1000.0
+        with self.lock:
+            self.count += 1
+            self.lastMs = ms
+            self.maxMs = max(self.maxMs, ms)
+            self.windowMaxMs = max(self.windowMaxMs, ms)
+
+    def sample(self, resetWindow=True):
+        with self.lock:
+            result = {"count": self.count, "lastMs": self.lastMs, "maxMs": self.maxMs, "windowMaxMs": self.windowMaxMs}
+            if resetWindow:
+                self.windowMaxMs = 0.0
+        return result
+
+
+def _countFds():
+    try:
+        return len(os.listdir("/proc/self/fd")) - 1   # minus the fd used by listdir itself
+    except OSError:
+        return None
+
+
+def _getRssBytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ResourceWatchdog(threading.Thread):
+
+    def __init__(self, statusFile, intervalS, maxFds, maxThreads, maxRssMB, maxLogBytes, maxActionMs, traceMalloc, logHandler=None, latencyStats=None, statusCallback=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.configure(statusFile=statusFile, intervalS=intervalS, maxFds=maxFds, maxThreads=maxThreads, maxRssMB=maxRssMB,
+                       maxLogBytes=maxLogBytes, maxActionMs=maxActionMs, traceMalloc=traceMalloc)
+        self.logHandler = logHandler
+        self.latencyStats = latencyStats if latencyStats is not None else {}
+        self.statusCallback = statusCallback
+
+        self.startTime = time.time()
+        self.wakeEvent = threading.Event()
+        self.isUp = False
+
+    def configure(self, statusFile, intervalS, maxFds, maxThreads, maxRssMB, maxLogBytes, maxActionMs, traceMalloc):
+        # budgets set to None are not checked
+        self.statusFile = statusFile
+        self.intervalS = intervalS
+        self.maxFds = maxFds
+        self.maxThreads = maxThreads
+        self.maxRssMB = maxRssMB
+        self.maxLogBytes = maxLogBytes
+        self.maxActionMs = maxActionMs
+        self.traceMalloc = traceMalloc
+
+    def _rotateLog(self, logSize):
+        if self.logHandler is None or self.maxLogBytes is None or logSize is None or logSize <= self.maxLogBytes:
+            return False
+        self.logHandler.acquire()
+        try:
+            self.logHandler.doRollover()
+        finally:
+            self.logHandler.release()
+        logging.info("rotated log file at " + str(logSize) + " bytes")
+        return True
+
+    def _getLogSize(self):
+        if self.logHandler is None:
+            return None
+        try:
+            return os.path.getsize(self.logHandler.baseFilename)
+        except OSError:
+            return None
+
+    def _topAllocations(self, limit=5):
+        if not self.traceMalloc:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            return None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return None   # nothing traced yet
+
+        stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+        return [{"where": str(s.traceback[0]), "sizeKB": round(s.size / 1024, 1), "count": s.count} for s in stats]
+
+    def sample(self, lagMs=0.0):
+        fds = _countFds()
+        threads = threading.active_count()
+        rss = _getRssBytes()
+        logSize = self._getLogSize()
+        latencies = {k: v.sample() for k, v in self.latencyStats.items()}
+
+        exceeded = []
+        if self.maxFds is not None and fds is not None and fds > self.maxFds:
+            exceeded.append("fds")
+        if self.maxThreads is not None and threads > self.maxThreads:
+            exceeded.append("threads")
+        if self.maxRssMB is not None and rss is not None and rss > self.maxRssMB * 1024 * 1024:
+            exceeded.append("rss")
+        if self.maxActionMs is not None and any(l["windowMaxMs"] > self.maxActionMs for l in latencies.values()):
+            exceeded.append("latency")
+        if self._rotateLog(logSize=logSize):
+            logSize = self._getLogSize()
+
+        status = {"time": round(time.time(), 1),
+                  "uptimeS": round(time.time() - self.startTime),
+                  "pid": os.getpid(),
+                  "fds": fds,
+                  "threads": threads,
+                  "rssKB": None if rss is None else rss // 1024,
+                  "logBytes": logSize,
+                  "lagMs": round(lagMs, 1),
+                  "latency": latencies,
+                  "exceeded": exceeded}
+
+        topAllocations = self._topAllocations()
+        if topAllocations is not None:
+            status["topAllocations"] = topAllocations
+
+        if self.statusCallback is not None:
+            try:
+                status.update(self.statusCallback())
+            except Exception as e:
+                logging.error('watchdog status callback failed: {e}'.format(e=e))
+
+        if len(exceeded) != 0:
+            logging.warning("resource budget exceeded: " + ", ".join(exceeded) + " " + json.dumps(status, separators=(",", ":")))
+
+        return status
+
+    def _writeStatus(self, status):
+        if self.statusFile is None:
+            return
+        writeFileAtomically(self.statusFile, json.dumps(status, separators=(",", ":")))   # scrapers never see a partially written file
+
+    def run(self):
+        self.isUp = True
+        expected = time.time()
+        while self.isUp:
+            lagMs = max(0.0, (time.time() - expected) * 1000.0)   # how late this thread was woken up
+            try:
+                self._writeStatus(self.sample(lagMs=lagMs))
+            except Exception as e:
+                logging.error('watchdog failed: {e}'.format(e=e))
+
+            expected = time.time() + self.intervalS
+            self.wakeEvent.wait(timeout=self.intervalS)
+            self.wakeEvent.clear()
+
+    def stop(self):
+        self.isUp = False
+        self.wakeEvent.set()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import os
+import json
+import time
+import logging
+import threading
+
+from AtomicFile import writeFileAtomically
+
+
+SNAPSHOT_VERSION = 1
+
+
+class StateSnapshot:
+    # periodically writes the dict returned by getState to snapshotFile, so that the next start can pick up where this one left off
+
+    def __init__(self, snapshotFile, intervalS, maxAgeS, getState):
+        self.snapshotFile = snapshotFile
+        self.configure(intervalS=intervalS, maxAgeS=maxAgeS)
+        self.getState = getState
+
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.lastState = None   # the state of the latest successful write
+
+    def configure(self, intervalS, maxAgeS):
+        self.intervalS = intervalS
+        self.maxAgeS = maxAgeS
+
+    def read(self):
+        # returns the saved state, or None if there is none or it is stale or corrupt
+        try:
+            with open(self.snapshotFile, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error('ignoring corrupt state snapshot: {e}'.format(e=e))
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get("version", None) != SNAPSHOT_VERSION or not isinstance(snapshot.get("state", None), dict):
+            logging.info("ignoring state snapshot with unknown format")
+            return None
+
+        snapshotTime = snapshot.get("time", None)
+        if isinstance(snapshotTime, bool) or not isinstance(snapshotTime, (int, float)):
+            logging.info("ignoring state snapshot without a valid time")
+            return None
+
+        age = time.time() - snapshotTime
+        if self.maxAgeS is not None and age > self.maxAgeS:
+            logging.info("ignoring state snapshot, it is {a:.0f}s old".format(a=age))
+            return None
+
+        return snapshot["state"]
+
+    def write(self, getState=None, lockTimeoutS=-1):
+        # getState overrides the callable given to the constructor for this write
+        if getState is None:
+            getState = self.getState
+
+        locked = self.lock.acquire(timeout=lockTimeoutS)
+        if not locked:
+            logging.error("periodic state snapshot is hanging, writing without it")
+        try:
+            try:
+                state = getState()
+            except Exception as e:
+                logging.error('failed to collect state for snapshot: {e}'.format(e=e))
+                return False
+
+            data = json.dumps({"version": SNAPSHOT_VERSION, "time": time.time(), "pid": os.getpid(), "state": state}, separators=(",", ":"))
+            try:
+                writeFileAtomically(self.snapshotFile, data)
+            except OSError as e:
+                logging.error('failed to write state snapshot: {e}'.format(e=e))
+                return False
+            self.lastState = state
+        finally:
+            if locked:
+                self.lock.release()
+        return True
+
+    def _run(self):
+        while not self.stopEvent.wait(timeout=self.intervalS):
+            self.write()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, getState=None, lockTimeoutS=2):
+        # writes a final snapshot; does not wait long for a periodic write that hangs, e.g. on an unreachable MPD
+        self.stopEvent.set()
+        return self.write(getState=getState, lockTimeoutS=lockTimeoutS)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+
+import json
+import time
+import logging
+import threading
+import urllib.request
+from urllib.parse import urljoin, urlparse
+
+from AtomicFile import writeFileAtomically
+
+
+PLAYLIST_CONTENT_TYPES = ["audio/x-mpegurl", "audio/mpegurl", "application/x-mpegurl", "audio/x-scpls", "application/pls+xml", "text/plain"]
+PLAYLIST_SUFFIXES = [".m3u", ".pls"]
+MAX_PLAYLIST_BYTES = 65536
+
+
+def parsePlaylist(text, baseuri):
+    # returns the stream URLs listed in an m3u or pls playlist; relative entries are resolved against baseuri
+    lines = [line.strip() for line in text.splitlines()]
+    isPls = any(line.lower() == "[playlist]" for line in lines)
+
+    urls = []
+    for line in lines:
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        if isPls:
+            key, sep, value = line.partition("=")
+            if line.startswith("[") or sep == "" or not key.strip().lower().startswith("file"):
+                continue   # section header or other pls entries, e.g. Title1=... or NumberOfEntries=...
+            line = value.strip()   # pls: File1=http://...
+        urls.append(urljoin(baseuri, line))
+    return urls
+
+
+class StreamResolver:
+
+    def __init__(self, cacheFile, ttlS, timeoutS):
+        self.cacheFile = cacheFile
+        self.configure(ttlS=ttlS, timeoutS=timeoutS)
+
+        self.lock = threading.Lock()
+        self.saveLock = threading.Lock()
+        self.refreshing = set()
+        self.entries = {}   # uri -> {"urls": [...], "time": ...}
+        self._load()
+
+    def configure(self, ttlS, timeoutS):
+        self.ttlS = ttlS
+        self.timeoutS = timeoutS
+
+    def _load(self):
+        if self.cacheFile is None:
+            return
+        try:
+            with open(self.cacheFile, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error('failed to read stream cache, starting empty: {e}'.format(e=e))
+
+    def _save(self):
+        if self.cacheFile is None:
+            return
+        with self.saveLock:   # prefetch, background refreshes and input threads may save at the same time; the last save must contain all entries
+            with self.lock:
+                data = json.dumps(self.entries)
+            try:
+                writeFileAtomically(self.cacheFile, data)
+            except OSError as e:
+                logging.error('failed to write stream cache: {e}'.format(e=e))
+
+    def _fetch(self, uri):
+        with urllib.request.urlopen(uri, timeout=self.timeoutS) as response:
+            contentType = response.headers.get_content_type()
+            path = urlparse(response.geturl()).path.lower()
+            if contentType not in PLAYLIST_CONTENT_TYPES and not any(path.endswith(s) for s in PLAYLIST_SUFFIXES):
+                return [uri]   # not a playlist, e.g. the server answered with the audio stream itself
+            charset = response.headers.get_content_charset() or "utf-8"
+            text = response.read(MAX_PLAYLIST_BYTES).decode(charset, errors="replace")
+
+        if "#EXT-X-" in text:
+            return [uri]   # HLS playlists list segments, not streams; MPD has to load those itself
+        return parsePlaylist(text=text, baseuri=response.geturl())
+
+    def refresh(self, uri):
+        # fetches uri and updates the cache; returns the stream URLs, or None if the fetch failed
+        try:
+            urls = self._fetch(uri)
+        except Exception as e:
+            logging.info('failed to fetch playlist ' + uri + ': {e}'.format(e=e))
+            return None
+
+        if len(urls) == 0:
+            logging.info("empty playlist: " + uri)
+            return None
+
+        with self.lock:
+            self.entries[uri] = {"urls": urls, "time": time.time()}
+        self._save()
+        return urls
+
+    def _refreshInBackground(self, uris):
+        with self.lock:
+            uris = [u for u in uris if u not in self.refreshing]
+            self.refreshing.update(uris)
+        if len(uris) == 0:
+            return
+
+        def _doRefresh():
+            try:
+                for uri in uris:
+                    self.refresh(uri)
+            finally:
+                with self.lock:
+                    self.refreshing.difference_update(uris)
+
+        threading.Thread(target=_doRefresh, daemon=True).start()
+
+    def isStale(self, uri):
+        entry = self.entries.get(uri, None)
+        return entry is None or time.time() - entry["time"] > self.ttlS
+
+    def resolve(self, uri):
+        # returns cached stream URLs for uri (stale ones if the network is down), or None if uri should be loaded as is;
+        # a missing entry is fetched in the background for the next time
+        if not uri.startswith("http://") and not uri.startswith("https://"):
+            return None
+
+        entry = self.entries.get(uri, None)
+        if self.isStale(uri):
+            self._refreshInBackground([uri])   # never fetches while the caller holds the MPD connection
+        if entry is None:
+            return None
+        return entry["urls"]
+
+    def prefetch(self, uris):
+        # fetches all uris that are not cached yet or are stale, in a background thread
+        self._refreshInBackground([u for u in uris if (u.startswith("http://") or u.startswith("https://")) and self.isStale(u)])
+
+    def sample(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "stale": sum(1 for u in self.entries if self.isStale(u)),
+                    "refreshing": len(self.refreshing)}
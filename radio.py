@@ -3,31 +3,43 @@
 
 
 import logging
+import logging.handlers
 #logfilename = '/var/tmp/radio-' + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + '.log'
 logfilename = '/var/tmp/radio.log'
-logging.basicConfig(filename=logfilename, filemode='w', level=logging.INFO)
+# no size limit here; the watchdog rolls the file over to radio.log.1 once it exceeds maxLogBytes
+logHandler = logging.handlers.RotatingFileHandler(logfilename, mode='w', maxBytes=0, backupCount=1)
+logging.basicConfig(handlers=[logHandler], level=logging.INFO)
 
 
+import os
 import time
 import datetime
 import json
 from pathlib import Path
 import subprocess
 import threading
+import signal
+import functools
 from contextlib import contextmanager
 from collections import deque
 
 import evdev
 from mpd import MPDClient
 from RFIDReader import RFIDReader
+from AudioCache import AudioCache, CACHE_DIRNAME
+from ResourceWatchdog import ResourceWatchdog, LatencyStats
+from StreamResolver import StreamResolver
+from ControlSocket import ControlSocket
+from StateSnapshot import StateSnapshot
 
 
 
-def _iterdir_recursive(path: Path, listdirs=True, listfiles=True):
+def _iterdir_recursive(path: Path, listdirs=True, listfiles=True, excludeDirs=None):
     # Recursive function to iterate through all files in a directory and its subdirectories (BFS order)
     # Returns files first, then directories
     # If listdirs is False, directories are not yielded
     # If listfiles is False, files are not yielded
+    # Directories whose name is in excludeDirs are neither yielded nor traversed
 
     queue = deque([path])
     visited = []
@@ -43,6 +55,8 @@ def _iterdir_recursive(path: Path, listdirs=True, listfiles=True):
         thefiles = []
         for p in current_path.iterdir():
             if p.is_dir():   # this follows symlinks
+                if excludeDirs is not None and p.name in excludeDirs:
+                    continue
                 thedirs.append(p)
             elif listfiles:
                 thefiles.append(p)
@@ -58,6 +72,109 @@ def _iterdir_recursive(path: Path, listdirs=True, listfiles=True):
             queue.append(r)
 
 
+class CardIndex():
+    # maps card ids to the folders that have them in their names, so that a tap does not need to walk the whole audiofolder tree.
+    # a miss or a folder that has disappeared triggers a rebuild, at most once every minRebuildIntervalS seconds;
+    # in between, only the top level of the audiofolder is checked, which is where new folders usually appear.
+    # the tree is walked without holding self.lock, so lookups that hit the current index never wait for a rebuild.
+    def __init__(self, absAudiofolder: Path, minRebuildIntervalS=10):
+        self.absAudiofolder = absAudiofolder
+        self.minRebuildIntervalS = minRebuildIntervalS
+
+        self.lock = threading.Lock()
+        self.buildLock = threading.Lock()   # one walk at a time
+        self.index = None
+        self.lastBuildTime = 0
+        self.lastBuildS = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.throttled = 0
+
+    def _walk(self):
+        index = {}
+        for c in _iterdir_recursive(self.absAudiofolder, listdirs=True, listfiles=False, excludeDirs=[CACHE_DIRNAME]):
+            relfolder = str(c.relative_to(self.absAudiofolder))
+            for cardid in c.name.split("-"):
+                index.setdefault(cardid, relfolder)   # the first folder in BFS order wins, as with the plain walk
+        return index
+
+    def _rebuild(self, builtBefore=None):
+        # returns the current index; if builtBefore is given, a build that finished since then (e.g. while waiting for buildLock) is reused
+        with self.buildLock:
+            with self.lock:
+                if self.index is not None and builtBefore is not None and self.lastBuildTime >= builtBefore:
+                    return self.index
+
+            starttime = time.time()
+            index = self._walk()
+            with self.lock:
+                self.index = index
+                self.lastBuildTime = time.time()
+                self.lastBuildS = self.lastBuildTime - starttime
+                self.builds += 1
+            return index
+
+    def build(self):
+        self._rebuild()
+
+    def _findTopLevel(self, cardid):
+        # same match as _walk, without descending into subfolders
+        try:
+            for c in sorted(self.absAudiofolder.iterdir(), key=lambda x: x.name.lower()):
+                if c.name != CACHE_DIRNAME and cardid in c.name.split("-") and c.is_dir():
+                    return str(c.relative_to(self.absAudiofolder))
+        except OSError as e:
+            logging.error('failed to list audiofolder: {e}'.format(e=e))
+        return None
+
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+
+    def export(self):
+        with self.lock:
+            return None if self.index is None else dict(self.index)
+
+    def restore(self, index):
+        # lastBuildTime stays 0, so the first miss rebuilds right away
+        with self.lock:
+            self.index = dict(index)
+
+    def lookup(self, cardid):
+        requestTime = time.time()
+        with self.lock:
+            index = self.index
+        if index is None:
+            index = self._rebuild(builtBefore=0)   # reuses a build that another thread has just finished
+
+        relfolder = index.get(cardid, None)
+        if relfolder is None or not (self.absAudiofolder / relfolder).is_dir():
+            if requestTime - self.lastBuildTime >= self.minRebuildIntervalS:
+                relfolder = self._rebuild(builtBefore=requestTime).get(cardid, None)
+            else:
+                relfolder = self._findTopLevel(cardid)   # a stale entry is dropped by the next rebuild
+                with self.lock:
+                    self.throttled += 1
+
+        with self.lock:
+            if relfolder is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return relfolder
+
+    def sample(self):
+        with self.lock:
+            return {"entries": None if self.index is None else len(self.index),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "builds": self.builds,
+                    "throttled": self.throttled,
+                    "minRebuildIntervalS": self.minRebuildIntervalS,
+                    "lastBuildMs": None if self.lastBuildS is None else round(self.lastBuildS * 1000.0, 1)}
+
+
 class MPDConnection():
     def __init__(self, host, port, pwd, closeAfterSeconds=7):
         self.client = MPDClient()
@@ -73,12 +190,24 @@ class MPDConnection():
         self.thetimer = None
         self.clientConnected = False
 
+    def _doClose(self):
+        if self.clientConnected:
+            self.client.close()
+            self.client.disconnect()
+            self.clientConnected = False
+
     def _closeConnection(self):
         with self.lock:
-            if self.clientConnected:
-                self.client.close()
-                self.client.disconnect()
-                self.clientConnected = False
+            self._doClose()
+
+    def configure(self, host, port, pwd):
+        # the next getConnectedClient() call reconnects using the new settings
+        with self.lock:
+            if (host, port, pwd) != (self.host, self.port, self.pwd):
+                self._doClose()
+                self.host = host
+                self.port = port
+                self.pwd = pwd
 
     @contextmanager
     def getConnectedClient(self):
@@ -99,15 +228,11 @@ class MPDConnection():
 
 
 class MusicPlayer():
-    def __init__(self, dir_path: Path, volumeSteps, minVolume, maxVolume, muteTimeoutS, doSavePos, alsaAudioDevice, doUpdateBeforePlaying):
+    def __init__(self, dir_path: Path, volumeSteps, minVolume, maxVolume, muteTimeoutS, doSavePos, alsaAudioDevice, doUpdateBeforePlaying, useAudioCache):
         self.dir_path = dir_path
-        self.volumeSteps = volumeSteps
-        self.minVolume = minVolume
-        self.maxVolume = maxVolume
-        self.muteTimeoutS = muteTimeoutS
-        self.doSavePos = doSavePos
-        self.alsaAudioDevice = alsaAudioDevice
-        self.doUpdateBeforePlaying = doUpdateBeforePlaying
+        self.configure(volumeSteps=volumeSteps, minVolume=minVolume, maxVolume=maxVolume, muteTimeoutS=muteTimeoutS,
+                       doSavePos=doSavePos, alsaAudioDevice=alsaAudioDevice, doUpdateBeforePlaying=doUpdateBeforePlaying,
+                       useAudioCache=useAudioCache)
 
         self.currentFolder = None
         self.currentFolderConf = None
@@ -119,6 +244,39 @@ class MusicPlayer():
         self.audiofolder = Path("shared", "audiofolders")
         self.shortcutsfolder = Path("shared", "shortcuts")
         self.absRecordingsDir = dir_path / self.audiofolder / "Recordings"
+        self.audioCache = AudioCache(absAudiofolder=dir_path / self.audiofolder)
+        self.actionLatency = LatencyStats()
+        self.streamResolver = None
+        self.cardIndex = CardIndex(absAudiofolder=dir_path / self.audiofolder)
+        self.folderConfCache = {}
+
+    def configure(self, volumeSteps, minVolume, maxVolume, muteTimeoutS, doSavePos, alsaAudioDevice, doUpdateBeforePlaying, useAudioCache):
+        # does not touch currentFolder or the MPD queue; a changed muteTimeoutS applies on the next updateTimer() call
+        self.volumeSteps = volumeSteps
+        self.minVolume = minVolume
+        self.maxVolume = maxVolume
+        self.muteTimeoutS = muteTimeoutS
+        self.doSavePos = doSavePos
+        self.alsaAudioDevice = alsaAudioDevice
+        self.doUpdateBeforePlaying = doUpdateBeforePlaying
+        self.useAudioCache = useAudioCache
+
+    def exportState(self):
+        return {"currentFolder": None if self.currentFolder is None else self.currentFolder.as_posix(),
+                "currentFolderConf": self.currentFolderConf,
+                "folderConfCache": dict(self.folderConfCache),
+                "cardIndex": self.cardIndex.export()}
+
+    def restoreState(self, state):
+        # the caches validate themselves on use, so restoring outdated entries is harmless
+        currentFolder = state.get("currentFolder", None)
+        self.currentFolder = None if currentFolder is None else Path(currentFolder)
+        self.currentFolderConf = state.get("currentFolderConf", None)
+        self.folderConfCache = dict(state.get("folderConfCache", None) or {})
+        if state.get("cardIndex", None) is not None:
+            self.cardIndex.restore(state["cardIndex"])
+        else:
+            self.cardIndex.invalidate()
 
     def _isRecording(self):
         return self.recordProcess is not None and self.recordProcess.poll() is None
@@ -156,22 +314,70 @@ class MusicPlayer():
                     return False
         return True
 
-    def playFolder(self, client, relfolder):
-        logging.info('playFolder: ' + str(relfolder))
-        self._stopAlsaProcesses()
-        self.savePos(client=client)
+    def _addCachedFolder(self, client, relfolder):
+        # adds the folder using the cached variants written by AudioCache.py; returns False if there are none
+        if not self.useAudioCache:
+            return False
+        try:
+            if not self.audioCache.load() or not self.audioCache.hasEntriesFor(relfolder.as_posix()):
+                return False
+        except Exception as e:
+            logging.error('failed to read audio cache: {e}'.format(e=e))
+            return False
 
-        absFolder = self.dir_path / self.audiofolder / relfolder
-        absFolderRel = self.dir_path / self.audiofolder
+        files = []
+        for entry in client.listall(relfolder.as_posix()):   # same order as client.add(folder)
+            relfile = entry.get("file", None)
+            if relfile is not None:
+                cached = self.audioCache.getCachedFile(relfile)
+                files.append(relfile if cached is None else cached)
 
-        folderConf = {}
+        try:
+            client.command_list_ok_begin()
+            for relfile in files:
+                client.add(relfile)
+            client.command_list_end()
+        except Exception as e:
+            logging.error('failed to add cached files, falling back to the original folder: {e}'.format(e=e))   # e.g., cache not in the MPD db yet
+            client.clear()
+            return False
+        return True
+
+    def getFolderConf(self, relfolder):
+        # merges the folder.json files from the top-level folder down to relfolder; cached until one of them changes
+        absFolderRel = self.dir_path / self.audiofolder
+        folderConfFiles = []
+        mtimes = []
         for r in relfolder.parts:
             absFolderRel = absFolderRel / r
             folderConfFile = absFolderRel / "folder.json"
-            if folderConfFile.exists():
+            folderConfFiles.append(folderConfFile)
+            try:
+                mtimes.append(folderConfFile.stat().st_mtime)
+            except OSError:
+                mtimes.append(None)
+
+        cached = self.folderConfCache.get(relfolder.as_posix(), None)
+        if cached is not None and cached["mtimes"] == mtimes:
+            return dict(cached["conf"])
+
+        folderConf = {}
+        for folderConfFile, mtime in zip(folderConfFiles, mtimes):
+            if mtime is not None:
                 with open(folderConfFile, "r") as folderConfFileObj:
                     folderConf |= json.load(folderConfFileObj)
 
+        self.folderConfCache[relfolder.as_posix()] = {"mtimes": mtimes, "conf": folderConf}
+        return dict(folderConf)
+
+    def playFolder(self, client, relfolder):
+        logging.info('playFolder: ' + str(relfolder))
+        self._stopAlsaProcesses()
+        self.savePos(client=client)
+
+        absFolder = self.dir_path / self.audiofolder / relfolder
+        folderConf = self.getFolderConf(relfolder=relfolder)
+
         self.currentFolder = relfolder
         self.currentFolderConf = folderConf
 
@@ -184,13 +390,16 @@ class MusicPlayer():
         if folderType in ["music"]:
             if self.doUpdateBeforePlaying:
                 client.update(relfolder)
+                if self.useAudioCache and (self.dir_path / self.audiofolder / CACHE_DIRNAME / relfolder).is_dir():
+                    client.update((Path(CACHE_DIRNAME) / relfolder).as_posix())
                 while True:
                     update_status = client.status().get("updating_db", None)
                     if update_status is None or len(update_status) == 0:
                         break
                     time.sleep(0.5)
 
-            client.add(relfolder.as_posix())
+            if not self._addCachedFolder(client=client, relfolder=relfolder):
+                client.add(relfolder.as_posix())
 
         elif folderType in ["stream"]:
             if theuri is not None:
@@ -198,7 +407,21 @@ class MusicPlayer():
 
         elif folderType in ["playlist", "playlist-stream"]:
             if theuri is not None:
-                client.load(theuri)
+                streamUrls = None
+                if folderType == "playlist-stream" and self.streamResolver is not None:
+                    streamUrls = self.streamResolver.resolve(str(theuri))
+                if streamUrls is not None:
+                    try:
+                        client.command_list_ok_begin()
+                        for streamUrl in streamUrls:
+                            client.add(streamUrl)
+                        client.command_list_end()
+                    except Exception as e:
+                        logging.error('failed to add cached stream urls, loading the playlist instead: {e}'.format(e=e))
+                        client.clear()
+                        streamUrls = None
+                if streamUrls is None:
+                    client.load(theuri)
 
         else:
             logging.info("unknown folder type: " + folderType)
@@ -317,6 +540,7 @@ class MusicPlayer():
                 return
 
     def updateDB(self, client, uri=None):
+        self.cardIndex.invalidate()
         if uri is None:
             client.update()
             #client.rescan()
@@ -408,6 +632,25 @@ def cmdAction(player, connection, actionstring):
             else:
                 logging.info("unknown cmd action: " + actionstring)
 
+def findStreamPlaylists(player):
+    # returns the uris of all playlist-stream folders, e.g. to prefetch them.
+    # folder configs are merged with their parents' as in playFolder, so "type" may be inherited from a parent folder.
+    af = player.dir_path / player.audiofolder
+    uris = []
+    for c in _iterdir_recursive(af, listdirs=True, listfiles=False, excludeDirs=[CACHE_DIRNAME]):
+        if not (c / "folder.json").is_file():
+            continue   # without its own folder.json, a folder has the same uri as its parent
+        try:
+            folderConf = player.getFolderConf(relfolder=c.relative_to(af))
+        except Exception as e:
+            logging.error("failed to parse folder.json in " + str(c) + ": {e}".format(e=e))
+            continue
+        theuri = folderConf.get("uri", None)
+        if folderConf.get("type", None) == "playlist-stream" and theuri is not None and theuri not in uris:
+            uris.append(theuri)
+    return uris
+
+
 def _get_existing_file(list_of_files):
     for l_file in list_of_files:
         if l_file.is_file():
@@ -415,7 +658,15 @@ def _get_existing_file(list_of_files):
     return None
 
 
-def resolveShortcut(dir_path: Path, shortcutsfolder, audiofolder, cardid):
+def parseShortcut(shortcut_content):
+    # "cmd://next" -> ("next", "cmd"); returns (None, "folder") if there is no prefix
+    shortcutPrefixPos = shortcut_content.find("://")
+    if shortcutPrefixPos == -1:
+        return None, "folder"
+    return shortcut_content[shortcutPrefixPos + 3:], shortcut_content[:shortcutPrefixPos]
+
+
+def resolveShortcut(dir_path: Path, shortcutsfolder, audiofolder, cardid, cardIndex=None):
     shortcutPrefix = None
     shortcut = None
 
@@ -431,10 +682,7 @@ def resolveShortcut(dir_path: Path, shortcutsfolder, audiofolder, cardid):
             with open(cardpath, "r") as f:
                 shortcut_content = f.read().strip()
 
-            shortcutPrefixPos = shortcut_content.find("://")
-            if shortcutPrefixPos != -1:
-                shortcutPrefix = shortcut_content[:shortcutPrefixPos]
-                shortcut = shortcut_content[shortcutPrefixPos + 3:]
+            shortcut, shortcutPrefix = parseShortcut(shortcut_content)
 
         else:
             abspath = cardpath
@@ -444,9 +692,14 @@ def resolveShortcut(dir_path: Path, shortcutsfolder, audiofolder, cardid):
                 abspath = (dir_path / audiofolder / abspath).resolve()
             shortcut = str((dir_path / audiofolder).relative_to(abspath))
 
+    elif cardIndex is not None:
+        shortcut = cardIndex.lookup(cardid)
+        if shortcut is not None:
+            shortcutPrefix = "folder"
+
     else:
         af = dir_path / audiofolder
-        for c in _iterdir_recursive(af, listdirs=True, listfiles=False):
+        for c in _iterdir_recursive(af, listdirs=True, listfiles=False, excludeDirs=[CACHE_DIRNAME]):
             if cardid in c.name.split("-"):
                 shortcutPrefix = "folder"
                 shortcut = str(c.relative_to(af))
@@ -459,9 +712,27 @@ def resolveShortcut(dir_path: Path, shortcutsfolder, audiofolder, cardid):
 
 
 def playAction(dir_path: Path, player, connection, cardid):
-    player.updateTimer(connection=connection)
-
-    shortcut, shortcutPrefix = resolveShortcut(dir_path=dir_path, shortcutsfolder=player.shortcutsfolder, audiofolder=player.audiofolder, cardid=cardid)
+    starttime = time.time()
+    try:
+        player.updateTimer(connection=connection)
+        shortcut, shortcutPrefix = resolveShortcut(dir_path=dir_path, shortcutsfolder=player.shortcutsfolder, audiofolder=player.audiofolder, cardid=cardid, cardIndex=player.cardIndex)
+        return performShortcut(player=player, connection=connection, shortcut=shortcut, shortcutPrefix=shortcutPrefix)
+    finally:
+        player.actionLatency.record(time.time() - starttime)
+
+
+def playShortcut(player, connection, shortcut_content):
+    # like playAction, but for a shortcut such as "cmd://next" instead of a card id
+    starttime = time.time()
+    try:
+        player.updateTimer(connection=connection)
+        shortcut, shortcutPrefix = parseShortcut(shortcut_content)
+        return performShortcut(player=player, connection=connection, shortcut=shortcut, shortcutPrefix=shortcutPrefix)
+    finally:
+        player.actionLatency.record(time.time() - starttime)
+
+
+def performShortcut(player, connection, shortcut, shortcutPrefix):
     if shortcut is None or shortcutPrefix is None:
         return None
 
@@ -492,9 +763,7 @@ class lircThread(threading.Thread):
         self.player = player
         self.connection = connection
         self.lircDevice = lircDevice
-        self.lockKeys = lockKeys
-        self.unlockKeys = unlockKeys
-        self.toggleLockKeys = toggleLockKeys
+        self.configure(lockKeys=lockKeys, unlockKeys=unlockKeys, toggleLockKeys=toggleLockKeys)
 
         self.isUp = False
         self.isLocked = lircLocked
@@ -510,6 +779,11 @@ class lircThread(threading.Thread):
                         'KEY_9': 9,
                         'KEY_0': 0}
 
+    def configure(self, lockKeys, unlockKeys, toggleLockKeys):
+        self.lockKeys = lockKeys
+        self.unlockKeys = unlockKeys
+        self.toggleLockKeys = toggleLockKeys
+
     def _getSeekSeconds(self, duration):
         return round(pow((3.0 * duration), 2), 1)
 
@@ -604,18 +878,20 @@ class rfidThread(threading.Thread):
         self.reader = reader
         self.player = player
         self.connection = connection
-        self.sameCardDelay = sameCardDelay
-        self.latestRFIDFile = latestRFIDFile
-        self.lockCardIDs = lockCardIDs
-        self.unlockCardIDs = unlockCardIDs
-        self.toggleLockCardIDs = toggleLockCardIDs
+        self.configure(sameCardDelay=sameCardDelay, latestRFIDFile=latestRFIDFile, lockCardIDs=lockCardIDs, unlockCardIDs=unlockCardIDs, toggleLockCardIDs=toggleLockCardIDs)
         self.prefix = prefix
 
         self.isUp = False
         self.isLocked = rfidLocked
 
+    def configure(self, sameCardDelay, latestRFIDFile, lockCardIDs, unlockCardIDs, toggleLockCardIDs):
+        self.sameCardDelay = sameCardDelay if sameCardDelay is not None else {}
+        self.latestRFIDFile = latestRFIDFile
+        self.lockCardIDs = lockCardIDs
+        self.unlockCardIDs = unlockCardIDs
+        self.toggleLockCardIDs = toggleLockCardIDs
+
     def run(self):
-        defaultCardDelay = self.sameCardDelay.get("default", 0)
         previous_performedAction = None
         previous_id = ""
         previous_time = 0
@@ -645,7 +921,8 @@ class rfidThread(threading.Thread):
                     if self.isLocked:
                         continue
 
-                    thisCardDelay = self.sameCardDelay.get(previous_performedAction, defaultCardDelay)
+                    sameCardDelay = self.sameCardDelay
+                    thisCardDelay = sameCardDelay.get(previous_performedAction, sameCardDelay.get("default", 0))
                     if cardid == previous_id and (time.time() - previous_time) < float(thisCardDelay):
                         logging.debug('Ignoring card due to sameCardDelay')
                     else:
@@ -661,6 +938,122 @@ class rfidThread(threading.Thread):
         self.isUp = False
 
 
+def getSnapshotState(player, connection, previousState=None):
+    # without a connection, the queue position is taken from previousState, e.g. at shutdown when MPD may not answer
+    state = player.exportState()
+    if connection is None:
+        if previousState is not None and "queue" in previousState:
+            state["queue"] = previousState["queue"]
+        return state
+
+    try:
+        with connection.getConnectedClient() as client:
+            status = client.status()
+            currentsong = client.currentsong()
+        state["queue"] = {"song": status.get("song", None),
+                          "elapsed": status.get("elapsed", None),
+                          "state": status.get("state", None),
+                          "playlistlength": status.get("playlistlength", None),
+                          "file": currentsong.get("file", None)}
+    except Exception as e:
+        logging.error('failed to get MPD status for snapshot: {e}'.format(e=e))
+    return state
+
+
+def resumeFromSnapshot(player, client, state):
+    # returns False if a cold start is needed
+    queue = state.get("queue", None) or {}
+    if player.currentFolder is None or not (player.dir_path / player.audiofolder / player.currentFolder).exists():
+        return False
+
+    status = client.status()
+    if int(status.get("playlistlength", 0)) > 0 and status.get("playlistlength", None) == queue.get("playlistlength", None) and client.currentsong().get("file", None) == queue.get("file", None):
+        logging.info("resuming from snapshot, MPD queue still intact: " + str(player.currentFolder))
+        return True
+
+    # MPD has lost the queue as well; rebuild it and go back to the saved position
+    logging.info("resuming from snapshot, rebuilding queue: " + str(player.currentFolder))
+    relfolder = player.currentFolder
+    player.currentFolder = None   # otherwise, playFolder would overwrite lastPos.json with the empty queue's position
+    player.playFolder(client=client, relfolder=relfolder)
+    if queue.get("song", None) is not None:
+        if queue.get("elapsed", None) is not None:
+            client.seek(queue["song"], queue["elapsed"])
+        else:
+            client.play(queue["song"])
+    if queue.get("state", None) != "play":
+        client.pause(1)
+    return True
+
+
+# only these shortcut types can be triggered through the control socket; extcmd:// would run arbitrary shell commands
+CONTROL_SHORTCUT_PREFIXES = ["cmd", "folder"]
+
+
+def _isSafeCardId(cardid):
+    # card ids are used as file names in resolveShortcut; "/tmp/x" or "../x" would point it at arbitrary shortcut files
+    return len(cardid) != 0 and "/" not in cardid and "\\" not in cardid and ".." not in cardid and not Path(cardid).is_absolute()
+
+
+def _isSafeRelFolder(relfolder):
+    # a folder below the audiofolders directory, not the directory itself
+    parts = Path(relfolder).parts
+    return len(parts) != 0 and "\\" not in relfolder and not Path(relfolder).is_absolute() and ".." not in parts
+
+
+def getState(player, inputThreads, connection=None):
+    # connection is only needed to include the MPD status; leaving it out avoids contention for the MPD connection
+    state = {"currentFolder": None if player.currentFolder is None else str(player.currentFolder),
+             "currentFolderConf": player.currentFolderConf,
+             "recording": player._isRecording(),
+             "inputs": [{"type": type(t).__name__, "alive": t.is_alive(), "locked": t.isLocked} for t in inputThreads],
+             "timings": {"action": player.actionLatency.sample(resetWindow=False)},
+             "cardIndex": player.cardIndex.sample()}
+    if player.streamResolver is not None:
+        state["streamCache"] = player.streamResolver.sample()
+    if connection is not None:
+        with connection.getConnectedClient() as client:
+            state["mpd"] = client.status()
+    return state
+
+
+def handleControlRequest(dir_path: Path, player, connection, inputThreads, actionLock, request):
+    op = request.get("op", None)
+
+    if op == "ping":
+        return {"ok": True}
+
+    elif op == "state":
+        return {"ok": True, "state": getState(player=player, inputThreads=inputThreads, connection=connection if request.get("mpd", False) else None)}
+
+    elif op in ["tap", "shortcut"]:
+        starttime = time.time()
+        with actionLock:   # at most one socket-triggered action at a time, so that scripts cannot starve the input threads
+            waitMs = (time.time() - starttime) * 1000.0
+            if op == "tap":
+                cardid = request.get("card", None)
+                if not isinstance(cardid, str) or len(cardid) == 0:
+                    raise ValueError("missing card")
+                if not _isSafeCardId(cardid):
+                    raise ValueError("invalid card: " + cardid)
+                logging.info("control socket tap: " + cardid)
+                result = playAction(dir_path=dir_path, player=player, connection=connection, cardid=cardid)
+            else:
+                shortcut_content = request.get("shortcut", None)
+                if not isinstance(shortcut_content, str):
+                    raise ValueError("missing shortcut")
+                shortcut, shortcutPrefix = parseShortcut(shortcut_content)
+                if shortcut is None or shortcutPrefix not in CONTROL_SHORTCUT_PREFIXES:
+                    raise ValueError("unsupported shortcut: " + shortcut_content)
+                if shortcutPrefix == "folder" and not _isSafeRelFolder(shortcut):
+                    raise ValueError("invalid folder: " + shortcut)
+                logging.info("control socket shortcut: " + shortcut_content)
+                result = playShortcut(player=player, connection=connection, shortcut_content=shortcut_content)
+        return {"ok": True, "action": result, "waitMs": round(waitMs, 1), "ms": round((time.time() - starttime) * 1000.0 - waitMs, 1)}
+
+    raise ValueError("unknown op: " + str(op))
+
+
 def getInputDevice(inputDevices, name):
     for i in inputDevices:
         if i.name == name:
@@ -668,36 +1061,282 @@ def getInputDevice(inputDevices, name):
     return None
 
 
+# settings that are only read at startup; changing them requires restarting radio.py
+RESTART_REQUIRED_KEYS = ["rfidReaderNames", "lirc", "lircdevice", "rfidLocked", "lircLocked", "initialVolume", "startupfolder", "streamCacheFile", "prefetchStreams", "controlSocket", "stateSnapshotFile"]
+# adding or removing the watchdog section requires a restart as well (see applyConfig); its settings can be changed at runtime
+
+
+def _checkType(config, key, types, typename):
+    val = config.get(key, None)
+    if val is None:
+        return
+    if not isinstance(val, types) or (isinstance(val, bool) and bool not in types):   # bool is a subclass of int
+        raise ValueError("config entry " + key + " must be " + typename)
+
+
+def validateConfig(config):
+    # raises ValueError if config cannot be used; does not modify config
+    if not isinstance(config, dict):
+        raise ValueError("config must be a JSON object")
+
+    for key in ["host", "port"]:
+        if key not in config:
+            raise ValueError("missing config entry: " + key)
+
+    _checkType(config, "host", (str,), "a string")
+    _checkType(config, "pwd", (str,), "a string")
+    _checkType(config, "alsaAudioDevice", (str,), "a string")
+    _checkType(config, "latestRFIDFile", (str,), "a string")
+    _checkType(config, "lircdevice", (str,), "a string")
+    _checkType(config, "startupfolder", (str,), "a string")
+    _checkType(config, "port", (int,), "an integer")
+    for key in ["minVolume", "maxVolume", "volumeSteps", "initialVolume"]:
+        _checkType(config, key, (int,), "an integer")
+    _checkType(config, "muteTimeoutS", (int, float), "a number")
+    for key in ["savePos", "updateBeforePlaying", "useAudioCache", "lirc", "rfidLocked", "lircLocked"]:
+        _checkType(config, key, (bool,), "true or false")
+    for key in ["rfidReaderNames", "lockCardIDs", "unlockCardIDs", "toggleLockCardIDs", "lockKeys", "unlockKeys", "toggleLockKeys"]:
+        _checkType(config, key, (list,), "a list")
+    _checkType(config, "soundEffects", (dict,), "an object")
+    _checkType(config, "sameCardDelay", (dict,), "an object")
+    _checkType(config, "watchdog", (dict,), "an object")
+    _checkType(config, "streamCacheFile", (str,), "a string")
+    _checkType(config, "streamCacheTTLS", (int, float), "a number")
+    _checkType(config, "streamTimeoutS", (int, float), "a number")
+    _checkType(config, "prefetchStreams", (bool,), "true or false")
+    _checkType(config, "controlSocket", (str,), "a string")
+    _checkType(config, "stateSnapshotFile", (str,), "a string")
+    _checkType(config, "stateSnapshotIntervalS", (int, float), "a number")
+    _checkType(config, "stateSnapshotMaxAgeS", (int, float), "a number")
+    if config.get("stateSnapshotIntervalS", 30) <= 0:
+        raise ValueError("config entry stateSnapshotIntervalS must be positive")
+
+    for action, delay in (config.get("sameCardDelay", None) or {}).items():
+        if isinstance(delay, bool) or not isinstance(delay, (int, float)):
+            raise ValueError("sameCardDelay for " + str(action) + " must be a number")
+
+    watchdogConfig = config.get("watchdog", None) or {}
+    _checkType(watchdogConfig, "statusFile", (str,), "a string")
+    _checkType(watchdogConfig, "intervalS", (int, float), "a number")
+    for key in ["maxFds", "maxThreads", "maxRssMB", "maxLogBytes", "maxActionMs"]:
+        _checkType(watchdogConfig, key, (int, float), "a number")
+    _checkType(watchdogConfig, "tracemalloc", (bool,), "true or false")
+    if watchdogConfig.get("intervalS", 60) <= 0:
+        raise ValueError("config entry intervalS must be positive")
+
+    minVolume = config.get("minVolume", None)
+    maxVolume = config.get("maxVolume", None)
+    if minVolume is not None and maxVolume is not None and minVolume > maxVolume:
+        raise ValueError("minVolume must not be greater than maxVolume")
+
+    if config.get("rfidReaderNames", None) is not None and "latestRFIDFile" not in config:
+        raise ValueError("missing config entry: latestRFIDFile")
+    if config.get("lirc", False) and "lircdevice" not in config:
+        raise ValueError("missing config entry: lircdevice")
+
+    return config
+
+
+INT_CONFIG_KEYS = ["port", "minVolume", "maxVolume", "volumeSteps", "initialVolume"]
+NUMBER_CONFIG_KEYS = ["muteTimeoutS", "streamCacheTTLS", "streamTimeoutS", "stateSnapshotIntervalS", "stateSnapshotMaxAgeS"]
+NUMBER_WATCHDOG_KEYS = ["intervalS", "maxFds", "maxThreads", "maxRssMB", "maxLogBytes", "maxActionMs"]
+
+
+def _coerce(val, convert):
+    # numbers given as strings (e.g. "port": "6600") have always been accepted; anything else is left for validateConfig to report
+    if isinstance(val, str):
+        try:
+            return convert(val.strip())
+        except ValueError:
+            pass
+    return val
+
+
+def _coerceNumbers(config):
+    if not isinstance(config, dict):
+        return config
+
+    config = dict(config)
+    for key in INT_CONFIG_KEYS:
+        if key in config:
+            config[key] = _coerce(config[key], int)
+    for key in NUMBER_CONFIG_KEYS:
+        if key in config:
+            config[key] = _coerce(config[key], float)
+    if isinstance(config.get("sameCardDelay", None), dict):
+        config["sameCardDelay"] = {k: _coerce(v, float) for k, v in config["sameCardDelay"].items()}
+    if isinstance(config.get("watchdog", None), dict):
+        config["watchdog"] = {k: _coerce(v, float) if k in NUMBER_WATCHDOG_KEYS else v for k, v in config["watchdog"].items()}
+    return config
+
+
+def loadConfig(dir_path: Path, strict=True):
+    # strict: raise ValueError for an unusable config (used to accept or reject a reload);
+    # otherwise, problems are only logged, so that a config that used to work still starts the player
+    with open(dir_path / "config.json", "r") as f:
+        config = _coerceNumbers(json.load(f))
+
+    if strict:
+        return validateConfig(config)
+
+    try:
+        validateConfig(config)
+    except ValueError as e:
+        logging.warning('config.json: {e}'.format(e=e))
+    return config
+
+
+def _connectionSettings(config):
+    return {"host": config["host"],
+            "port": config["port"],
+            "pwd": config.get("pwd", None)}
+
+
+def _playerSettings(config):
+    return {"volumeSteps": config.get("volumeSteps", 5),
+            "minVolume": config.get("minVolume", None),
+            "maxVolume": config.get("maxVolume", None),
+            "muteTimeoutS": config.get("muteTimeoutS", None),
+            "doSavePos": config.get("savePos", True),
+            "alsaAudioDevice": config.get("alsaAudioDevice", "default"),
+            "doUpdateBeforePlaying": config.get("updateBeforePlaying", True),
+            "useAudioCache": config.get("useAudioCache", True)}
+
+
+def _rfidSettings(config, latestRFIDFile=None):
+    # latestRFIDFile: kept if config does not set it, e.g. because rfidReaderNames was removed and only takes effect on restart
+    if "latestRFIDFile" in config:
+        latestRFIDFile = Path(config["latestRFIDFile"])
+    return {"sameCardDelay": config.get("sameCardDelay", None),
+            "latestRFIDFile": latestRFIDFile,
+            "lockCardIDs": config.get("lockCardIDs", None),
+            "unlockCardIDs": config.get("unlockCardIDs", None),
+            "toggleLockCardIDs": config.get("toggleLockCardIDs", None)}
+
+
+def _lircSettings(config):
+    return {"lockKeys": config.get("lockKeys", None),
+            "unlockKeys": config.get("unlockKeys", None),
+            "toggleLockKeys": config.get("toggleLockKeys", None)}
+
+
+def _streamSettings(config):
+    return {"ttlS": config.get("streamCacheTTLS", 86400),
+            "timeoutS": config.get("streamTimeoutS", 5)}
+
+
+def _snapshotSettings(config):
+    return {"intervalS": config.get("stateSnapshotIntervalS", 30),
+            "maxAgeS": config.get("stateSnapshotMaxAgeS", 3600)}
+
+
+def _watchdogSettings(config):
+    watchdogConfig = config.get("watchdog", None) or {}
+    return {"statusFile": watchdogConfig.get("statusFile", "/var/tmp/radio-status.json"),
+            "intervalS": watchdogConfig.get("intervalS", 60),
+            "maxFds": watchdogConfig.get("maxFds", None),
+            "maxThreads": watchdogConfig.get("maxThreads", None),
+            "maxRssMB": watchdogConfig.get("maxRssMB", None),
+            "maxLogBytes": watchdogConfig.get("maxLogBytes", None),
+            "maxActionMs": watchdogConfig.get("maxActionMs", None),
+            "traceMalloc": watchdogConfig.get("tracemalloc", False)}
+
+
+def applyConfig(oldConfig, config, connection, player, inputThreads, watchdog=None, stateSnapshot=None):
+    # reconfigures the running components in place; threads, the MPD queue and the playback position are left untouched.
+    # all settings are derived before the first component is touched, so a failure leaves the previous config in effect.
+    connectionSettings = _connectionSettings(config)
+    playerSettings = _playerSettings(config)
+    streamSettings = _streamSettings(config)
+    soundEffects = config.get("soundEffects", {})
+    threadSettings = []
+    for t in inputThreads:
+        if isinstance(t, rfidThread):
+            threadSettings.append((t, _rfidSettings(config, latestRFIDFile=t.latestRFIDFile)))
+        elif isinstance(t, lircThread):
+            threadSettings.append((t, _lircSettings(config)))
+    if watchdog is not None:
+        threadSettings.append((watchdog, _watchdogSettings(config)))
+    if stateSnapshot is not None:
+        threadSettings.append((stateSnapshot, _snapshotSettings(config)))
+
+    for key in RESTART_REQUIRED_KEYS:
+        if oldConfig.get(key, None) != config.get(key, None):
+            logging.warning("config entry " + key + " changed; restart radio.py to apply it")
+    if ("watchdog" in oldConfig) != ("watchdog" in config):
+        logging.warning("config entry watchdog " + ("added" if "watchdog" in config else "removed") + "; restart radio.py to apply it")
+
+    if _connectionSettings(oldConfig) != connectionSettings:
+        connection.configure(**connectionSettings)
+
+    if _playerSettings(oldConfig) != playerSettings:
+        player.configure(**playerSettings)
+    player.soundEffects = soundEffects
+    if player.streamResolver is not None:
+        player.streamResolver.configure(**streamSettings)
+
+    for t, settings in threadSettings:
+        t.configure(**settings)
+
+
+def reloadConfig(dir_path: Path, oldConfig, connection, player, inputThreads, watchdog=None, stateSnapshot=None):
+    # returns the config that is in effect afterwards
+    try:
+        config = loadConfig(dir_path=dir_path)
+    except Exception as e:
+        logging.error('config reload failed, keeping previous config: {e}'.format(e=e))
+        return oldConfig
+
+    try:
+        applyConfig(oldConfig=oldConfig, config=config, connection=connection, player=player, inputThreads=inputThreads, watchdog=watchdog, stateSnapshot=stateSnapshot)
+    except Exception as e:
+        logging.error('config reload failed, keeping previous config: {e}'.format(e=e))
+        return oldConfig
+
+    logging.info("config reloaded")
+    return config
+
+
 if __name__ == "__main__":
     dir_path = Path(__file__).resolve().parent
     logging.info('dir_path: ' + str(dir_path))
 
-    with open(dir_path / "config.json", "r") as f:
-        config = json.load(f)
+    config = loadConfig(dir_path=dir_path, strict=False)
 
-    connection = MPDConnection(host=config["host"], port=config["port"], pwd=config.get("pwd", None))
+    connection = MPDConnection(**_connectionSettings(config))
     inputDevices = [evdev.InputDevice(path) for path in evdev.list_devices()]
 
-    player = MusicPlayer(dir_path=dir_path,
-                         volumeSteps=config.get("volumeSteps", 5),
-                         minVolume=config.get("minVolume", None),
-                         maxVolume=config.get("maxVolume", None),
-                         muteTimeoutS=config.get("muteTimeoutS", None),
-                         doSavePos=config.get("savePos", True),
-                         alsaAudioDevice=config.get("alsaAudioDevice", "default"),
-                         doUpdateBeforePlaying=config.get("updateBeforePlaying", True))
+    player = MusicPlayer(dir_path=dir_path, **_playerSettings(config))
+    player.streamResolver = StreamResolver(cacheFile=config.get("streamCacheFile", "/var/tmp/radio-streams.json"), **_streamSettings(config))
+
+    # a recent snapshot (e.g., after a crash or a watchdog restart) restores the current folder and the warm caches
+    stateSnapshot = None
+    restoredState = None
+    if config.get("stateSnapshotFile", "/var/tmp/radio-state.json") is not None:
+        stateSnapshot = StateSnapshot(snapshotFile=config.get("stateSnapshotFile", "/var/tmp/radio-state.json"),
+                                      getState=lambda: getSnapshotState(player=player, connection=connection),
+                                      **_snapshotSettings(config))
+        restoredState = stateSnapshot.read()
+        if restoredState is not None:
+            try:
+                player.restoreState(restoredState)
+            except Exception as e:
+                logging.error('failed to restore state snapshot, doing a cold start: {e}'.format(e=e))
+                player.restoreState({})
+                restoredState = None
+
+    if player.cardIndex.export() is None:
+        threading.Thread(target=player.cardIndex.build, daemon=True).start()   # so that the first tap does not have to wait for it
+    if config.get("prefetchStreams", True):
+        threading.Thread(target=lambda: player.streamResolver.prefetch(findStreamPlaylists(player=player)), daemon=True).start()
 
     inputThreads = []
     if config.get("rfidReaderNames", None) is not None:
         for rfidReaderName in config["rfidReaderNames"]:
             reader = RFIDReader(rfidReaderName=rfidReaderName)
             inputThreads.append(rfidThread(dir_path=dir_path, reader=reader, player=player, connection=connection,
-                                        sameCardDelay=config.get("sameCardDelay", None),
-                                        latestRFIDFile=Path(config["latestRFIDFile"]),
-                                        lockCardIDs=config.get("lockCardIDs", None),
-                                        unlockCardIDs=config.get("unlockCardIDs", None),
-                                        toggleLockCardIDs=config.get("toggleLockCardIDs", None),
-                                        rfidLocked=config.get("rfidLocked", False)))
+                                        rfidLocked=config.get("rfidLocked", False),
+                                        **_rfidSettings(config)))
 
     if config.get("lirc", False):
         lircDevice = getInputDevice(inputDevices=inputDevices, name=config["lircdevice"])
@@ -707,29 +1346,92 @@ if __name__ == "__main__":
             logging.info("found IR device: " + str(lircDevice.path + " " + lircDevice.name + " " + lircDevice.phys))
             inputThreads.append(lircThread(dir_path=dir_path, player=player, connection=connection,
                                         lircDevice=lircDevice,
-                                        lockKeys=config.get("lockKeys", None),
-                                        unlockKeys=config.get("unlockKeys", None),
-                                        toggleLockKeys=config.get("toggleLockKeys", None),
-                                        lircLocked=config.get("lircLocked", False)))
-
-    with connection.getConnectedClient() as client:
-        #client.enableoutput(0)
-        client.clear()
-        if "initialVolume" in config:
-            client.setvol(config["initialVolume"])
-
-        client.update()   # or: client.rescan() ?
-        for t in inputThreads:
-            t.start()
-
-        startupfolder = config.get("startupfolder", None)
-        player.soundEffects = config.get("soundEffects", {})
-        startupsound = player.soundEffects.get("startup", None)
-        if startupfolder is not None:
-            player.playFolder(client=client, relfolder=Path(startupfolder))
-        elif startupsound is not None:
-            player.playSingleFile(client=client, relSoundFile=Path(startupsound))
+                                        lircLocked=config.get("lircLocked", False),
+                                        **_lircSettings(config)))
+
+    watchdog = None
+    if config.get("watchdog", None) is not None:
+        watchdog = ResourceWatchdog(logHandler=logHandler,
+                                    latencyStats={"action": player.actionLatency},
+                                    statusCallback=lambda: {"currentFolder": None if player.currentFolder is None else str(player.currentFolder)},
+                                    **_watchdogSettings(config))
+        watchdog.start()
+
+    controlSocket = None
+    if config.get("controlSocket", None) is not None:
+        controlSocket = ControlSocket(socketPath=config["controlSocket"],
+                                      handleRequest=functools.partial(handleControlRequest, dir_path, player, connection, inputThreads, threading.Lock()))
+        controlSocket.start()
+
+    # "kill -HUP <pid>" reloads config.json; the actual reload happens in the main loop below, not in the signal handler
+    reloadRequested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloadRequested.set())
+    shutdownRequested = threading.Event()
+    mainLoopGone = threading.Event()
+
+    def _shutdown():
+        logging.info("shutting down")
+        if controlSocket is not None:
+            controlSocket.stop()   # removes the socket file
+        if stateSnapshot is not None:
+            stateSnapshot.stop(getState=lambda: getSnapshotState(player=player, connection=None, previousState=stateSnapshot.lastState))
+        logging.shutdown()
+        os._exit(0)   # the input threads are blocked in device reads and cannot be joined
+
+    def _requestShutdown(signum, frame):
+        shutdownRequested.set()
+        reloadRequested.set()   # wakes up the main loop
+        if mainLoopGone.is_set():
+            _shutdown()   # the main loop has ended with an exception; nothing else would stop the input threads
+
+    signal.signal(signal.SIGTERM, _requestShutdown)
+    signal.signal(signal.SIGINT, _requestShutdown)
+
+    try:
+        with connection.getConnectedClient() as client:
+            resumed = False
+            if restoredState is not None:
+                try:
+                    resumed = resumeFromSnapshot(player=player, client=client, state=restoredState)
+                except Exception as e:
+                    logging.error('failed to resume from state snapshot, doing a cold start: {e}'.format(e=e))
+                if not resumed:
+                    player.currentFolder = None
+                    player.currentFolderConf = None
+
+            if not resumed:
+                #client.enableoutput(0)
+                client.clear()
+                if "initialVolume" in config:
+                    client.setvol(config["initialVolume"])
+
+            client.update()   # or: client.rescan() ?
+            for t in inputThreads:
+                t.start()
+
+            player.soundEffects = config.get("soundEffects", {})
+            if not resumed:
+                startupfolder = config.get("startupfolder", None)
+                startupsound = player.soundEffects.get("startup", None)
+                if startupfolder is not None:
+                    player.playFolder(client=client, relfolder=Path(startupfolder))
+                elif startupsound is not None:
+                    player.playSingleFile(client=client, relSoundFile=Path(startupsound))
 
-    for t2 in inputThreads:
-        t2.join()
+        if stateSnapshot is not None:
+            stateSnapshot.start()
 
+        while controlSocket is not None or any(t2.is_alive() for t2 in inputThreads):
+            if reloadRequested.wait(timeout=1):
+                reloadRequested.clear()
+                if shutdownRequested.is_set():
+                    break
+                config = reloadConfig(dir_path=dir_path, oldConfig=config, connection=connection, player=player, inputThreads=inputThreads,
+                                      watchdog=watchdog, stateSnapshot=stateSnapshot)
+    finally:
+        mainLoopGone.set()
+
+    if shutdownRequested.is_set():
+        _shutdown()
+    if stateSnapshot is not None:
+        stateSnapshot.stop()